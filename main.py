@@ -1,3 +1,4 @@
+import atexit
 import json
 import telebot
 from telebot import types
@@ -5,9 +6,15 @@ import threading
 import time
 import logging
 import re
+import signal
 import sqlite3
+import sys
 import dotenv
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from cachetools import LRUCache
 
 dotenv.load_dotenv()
 
@@ -17,21 +24,104 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_FILE = "whispry_data.db"  # SQLite database file
 DELETE_WEBHOOKS_ON_STARTUP = True
 DELETE_WEBHOOKS_ON_NEW_BOT = True
+WEBHOOK_DELETE_WORKERS = 32  # Concurrent delete_webhook calls on startup
+BOT_STARTUP_WORKERS = 16  # Managed bots started concurrently on startup
+MESSAGE_COUNT_FLUSH_THRESHOLD = 50  # Pending increments before writing to the DB
+MESSAGE_COUNT_FLUSH_INTERVAL = 5  # Seconds between writes, whichever comes first
+MESSAGE_MAPPING_CACHE_SIZE = 100_000  # Most recent mappings kept in memory, the rest stay in the DB
+
+DB_CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+_TOKEN_RE = re.compile(r"\A[0-9]+:[a-zA-Z0-9_-]+\Z")  # Telegram bot token format
+
+# --- SQL ---
+# Kept as constants so every call passes the identical string and hits the statement cache.
+SQL_GET_COUNT = "SELECT message_count FROM message_counts WHERE token = ?"
+SQL_INC = """
+    INSERT INTO message_counts (token, owner_id, message_count)
+    VALUES (?, ?, ?)
+    ON CONFLICT(token) DO UPDATE SET message_count = message_count + excluded.message_count
+    RETURNING message_count
+"""
+SQL_COUNT_OWNER_BOTS = "SELECT COUNT(*) FROM bots WHERE owner_id = ?"
+# Whitelist of bot settings that owners may change, one UPDATE per column
+SQL_UPDATE_BOT_FIELD = {
+    field: f"UPDATE bots SET {field} = ? WHERE owner_id = ? AND token = ?"
+    for field in ("start_message", "first_reply")
+}
+SQL_STORE_MAP = """
+    INSERT INTO message_mappings (owner_id, forwarded_message_id, user_id)
+    VALUES (?, ?, ?)
+    ON CONFLICT(owner_id, forwarded_message_id) DO NOTHING  -- Prevent duplicates
+"""
+SQL_GET_USER = "SELECT user_id FROM message_mappings WHERE owner_id = ? AND forwarded_message_id = ?"
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def find_first_key_with_prefix(data_dict, prefix):
-    """Finds the first key in a dictionary that starts with a specific prefix."""
-    for key in data_dict:
-        if key.startswith(prefix):
-            return key
-    return None
-
-def init_db():
+def connect_db(read_only=False):
+    """Opens a database connection tuned for a long-lived, shared handle."""
+    if read_only:
+        # Autocommit: readers only run SELECTs, so the driver never wraps them in BEGIN/COMMIT
+        conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False,
+                               cached_statements=DB_CACHED_STATEMENTS, isolation_level=None)
+    else:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+        conn.execute("PRAGMA journal_mode=WAL")  # Persistent, readers inherit it
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=memory")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+class ConnectionPool:
+    """A single writer connection plus one read-only connection per thread.
+
+    SQLite in WAL mode allows many concurrent readers alongside one writer,
+    so reads never wait behind the write lock. Each bot polls on its own
+    thread, so a thread-local reader is opened once and then reused without
+    contending with other threads.
+    """
+
+    def __init__(self):
+        self._writer = connect_db()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()  # Closed with the thread's locals when it exits
+
+    @contextmanager
+    def read(self):
+        """Yields this thread's read-only connection, opening it on first use."""
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            conn = self._local.reader = connect_db(read_only=True)
+        yield conn
+
+    @contextmanager
+    def write(self):
+        """Holds the writer lock inside a BEGIN IMMEDIATE transaction, committed (or rolled back) on exit."""
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            with self._writer:
+                yield self._writer
+
+
+def _rebuild_with_integer_owner_id(cursor, table, create_sql):
+    """Rebuilds a table created with owner_id TEXT so owner_id is stored as INTEGER."""
+    columns = {row[1]: row[2] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+    if columns["owner_id"].upper() == "INTEGER":
+        return
+    logger.info(f"Migrating {table}.owner_id to INTEGER...")
+    column_list = ", ".join(columns)
+    select_list = ", ".join("CAST(owner_id AS INTEGER)" if column == "owner_id" else column for column in columns)
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    cursor.execute(create_sql)
+    cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {select_list} FROM {table}_old")
+    cursor.execute(f"DROP TABLE {table}_old")
+
+
+def init_db(pool):
     """Initializes the SQLite database."""
-    with sqlite3.connect(DB_FILE) as conn:
+    with pool.write() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS message_counts (
@@ -40,80 +130,130 @@ def init_db():
                 message_count INTEGER DEFAULT 0
             )
         """)
-        cursor.execute("""
+        create_message_mappings = """
             CREATE TABLE IF NOT EXISTS message_mappings (
-                owner_id TEXT,
+                owner_id INTEGER,
                 forwarded_message_id TEXT,
                 user_id INTEGER,
                 PRIMARY KEY (owner_id, forwarded_message_id)
             )
-        """)
-        cursor.execute("""
+        """
+        cursor.execute(create_message_mappings)
+        create_bots = """
            CREATE TABLE IF NOT EXISTS bots (
-               owner_id TEXT,
+               owner_id INTEGER,
                token TEXT,
                start_message TEXT,
                first_reply TEXT,
                PRIMARY KEY (owner_id, token)
            )
-        """)
-
-        conn.commit()
+        """
+        cursor.execute(create_bots)
+        # Databases created before owner_id was an INTEGER column
+        _rebuild_with_integer_owner_id(cursor, "message_mappings", create_message_mappings)
+        _rebuild_with_integer_owner_id(cursor, "bots", create_bots)
+        # Lookups by owner_id on bots are already served by the (owner_id, token) primary key.
+        # For future owner-level aggregates over message_counts (nothing filters on it yet).
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mc_owner ON message_counts(owner_id)")
+        cursor.execute("DROP INDEX IF EXISTS idx_bots_token")  # Served no query
 
 
 # --- Data Structures ---
 class WhispryBot:
-    def __init__(self, token, owner_id, main_bot, start_message="", first_reply=""):
+    def __init__(self, token, owner_id, main_bot, pool, start_message="", first_reply=""):
         self.token = token
         self.owner_id = owner_id
-        self.bot = telebot.TeleBot(token, parse_mode="HTML")
+        # Handlers run on the polling thread itself instead of a per-bot worker pool.
+        # An exception escaping a handler would abort the rest of its getUpdates batch
+        # (the offset has already moved on), so every handler catches and logs its own errors.
+        self.bot = telebot.TeleBot(token, parse_mode="HTML", threaded=False)
+        self.username = self.bot.get_me().username  # Cached, it's shown on every /mybots page
         self.main_bot = main_bot
+        self.pool = pool
         self.start_message = start_message
         self.first_reply = first_reply
         self.message_counter = self.get_initial_message_count()  # Load from DB
+        self._count_lock = threading.Lock()
+        self._pending_increments = 0  # Counted in memory, not yet written to the DB
+        self._last_flush = time.monotonic()
         self.setup_handlers()
-        self.running = True
-        self.thread = threading.Thread(target=self.run_polling)
+        self.thread = threading.Thread(target=self.run_polling, daemon=True)
         self.thread.start()
 
 
     def get_initial_message_count(self):
         """Retrieves the initial message count from the database."""
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT message_count FROM message_counts WHERE token = ?", (self.token,))
+        with self.pool.read() as conn:
+            cursor = conn.execute(SQL_GET_COUNT, (self.token,))
             result = cursor.fetchone()
-            return result[0] if result else 0
+        return result[0] if result else 0
 
     def increment_message_count(self):
-        """Increments the message count in memory and the database."""
-        self.message_counter += 1
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO message_counts (token, owner_id, message_count)
-                VALUES (?, ?, ?)
-                ON CONFLICT(token) DO UPDATE SET message_count = message_count + 1
-            """, (self.token, self.owner_id, self.message_counter))  # Use parameterized query
-            conn.commit()
+        """Increments the message count in memory; the database is updated in batches."""
+        main_whispry.adjust_stats(messages=1)
+        with self._count_lock:
+            self.message_counter += 1
+            self._pending_increments += 1
+            flush_due = (self._pending_increments >= MESSAGE_COUNT_FLUSH_THRESHOLD
+                         or time.monotonic() - self._last_flush >= MESSAGE_COUNT_FLUSH_INTERVAL)
+        if flush_due:
+            try:
+                self.flush_message_count()
+            except Exception as e:
+                # The delta stays pending and is retried; don't fail the message handler over it
+                logger.exception(f"Failed to flush message count for bot {self.token[-6:]}: {e}")
+
+    def flush_message_count(self):
+        """Writes the pending increments to the database in a single transaction.
+
+        Raises on database errors after putting the delta back as pending.
+        """
+        if not self._pending_increments:  # Unlocked peek so idle bots don't take the writer lock
+            return
+        pending = 0
+        try:
+            with self.pool.write() as conn:
+                # Take the delta only while holding the writer lock, so it is never held outside it:
+                # once delete_bot's stop_polling() flush returns, no write for this token is in flight.
+                # Lock order is writer -> count; increment_message_count only takes the count lock.
+                with self._count_lock:
+                    pending, self._pending_increments = self._pending_increments, 0
+                    self._last_flush = time.monotonic()
+                if not pending:
+                    return
+                # SQLite applies the delta and returns the stored total atomically
+                stored_count = conn.execute(SQL_INC, (self.token, self.owner_id, pending)).fetchone()[0]
+        except Exception:
+            with self._count_lock:
+                self._pending_increments += pending  # Retry on the next flush
+            raise
+        with self._count_lock:
+            # Increments counted while the write ran are still pending on top of the stored total
+            self.message_counter = stored_count + self._pending_increments
 
     def setup_handlers(self):
         # General command handler (for /about and /help)
         @self.bot.message_handler(commands=['about', 'help'])
         def handle_general_commands(message):
             if message.chat.type == 'private':
-                if message.text == '/about':
-                    about_text = "This bot is made with @WhispryBot, an ads-free feedback bot."
-                    self.bot.send_message(message.chat.id, about_text)
-                elif message.text == '/help':
-                    self.bot.send_message(message.chat.id, "This is a feedback bot. Send messages to contact the owner.")
+                try:
+                    if message.text == '/about':
+                        about_text = "This bot is made with @WhispryBot, an ads-free feedback bot."
+                        self.bot.send_message(message.chat.id, about_text)
+                    elif message.text == '/help':
+                        self.bot.send_message(message.chat.id, "This is a feedback bot. Send messages to contact the owner.")
+                except Exception as e:
+                    logger.exception(f"Error handling command in bot {self.token[-6:]}: {e}")
 
         @self.bot.message_handler(commands=['start'])
         def handle_start(message):
             if message.chat.type == 'private':
                 start_text = self.start_message or "Welcome!"
                 start_text += "\n\nPowered by @WhispryBot"
-                self.bot.send_message(message.chat.id, start_text)
+                try:
+                    self.bot.send_message(message.chat.id, start_text)
+                except Exception as e:
+                    logger.exception(f"Error handling /start in bot {self.token[-6:]}: {e}")
 
         @self.bot.message_handler(func=lambda message: True, content_types=['text', 'photo', 'video', 'document', 'audio', 'voice', 'sticker'])
         def handle_all_messages(message):
@@ -153,26 +293,32 @@ class WhispryBot:
                 except telebot.apihelper.ApiTelegramException as e:
                     logger.exception(f"Telegram API Error: {e}")
                     if "bot was blocked by the user" in str(e).lower():
-                        self.main_bot.send_message(self.owner_id, "The user has blocked your bot.")
+                        self.notify_owner("The user has blocked your bot.")
                     elif "forbidden: bot can't initiate conversation with a user" in str(e).lower():
-                        self.main_bot.send_message(self.owner_id, "The user has not started a conversation with your bot.")
+                        self.notify_owner("The user has not started a conversation with your bot.")
                     else:
-                        self.main_bot.send_message(self.owner_id, "An error occurred while sending a message.")
+                        self.notify_owner("An error occurred while sending a message.")
+                except Exception as e:
+                    # Network or database errors; logged so the rest of the update batch still runs
+                    logger.exception(f"Error handling message in bot {self.token[-6:]}: {e}")
+
+    def notify_owner(self, text):
+        """Tells the owner about a failure via the main bot, logging if that fails too."""
+        try:
+            self.main_bot.send_message(self.owner_id, text)
+        except Exception as e:
+            logger.exception(f"Failed to notify owner {self.owner_id}: {e}")
 
     def run_polling(self):
-        logger.info(f"Starting polling for bot {self.bot.get_me().username} (owner: {self.owner_id})")
-        while self.running:
-            try:
-                self.bot.polling(none_stop=True, interval=1, timeout=30)
-            except Exception as e:
-                logger.exception(f"Polling error: {e}")
-                time.sleep(15)
+        logger.info(f"Starting polling for bot {self.username} (owner: {self.owner_id})")
+        # Long polling with no interval; infinity_polling retries on errors until stop_polling()
+        self.bot.infinity_polling(timeout=30, long_polling_timeout=30, logger_level=logging.ERROR)
         logger.info("Stopped polling")
 
     def stop_polling(self):
-        self.running = False
         self.bot.stop_polling()
         self.thread.join()
+        self.flush_message_count()
 
     def get_stats(self):
         return self.message_counter
@@ -181,55 +327,59 @@ class WhispryBot:
 class Whispry:
     def __init__(self, bot_token):
         self.bot = telebot.TeleBot(bot_token)
-        init_db() # Initialize the database
+        self.pool = ConnectionPool()  # Shared connections, reused by every handler
+        init_db(self.pool) # Initialize the database
         self.bots = {}
-        self.message_mappings = {}  # Still in memory, but persisted to DB
+        self.bots_by_owner = defaultdict(set)  # owner_id -> tokens, mirrors self.bots
+        # (owner_id, forwarded_message_id) -> user_id; misses fall back to the DB
+        self.message_mappings = LRUCache(maxsize=MESSAGE_MAPPING_CACHE_SIZE)
+        self._mappings_lock = threading.Lock()  # LRUCache is not thread-safe
         self.load_bots()
-        self.load_message_mappings() # Load mappings from DB
         self.setup_handlers()
         self.total_bots_count = 0
         self.total_messages_count = 0
-        self.update_stats()
+        self._stats_lock = threading.Lock()
+        self.update_stats()  # Loaded once, then kept up to date by adjust_stats()
+        atexit.register(self.flush_message_counts)  # Not run on SIGTERM, see run()
+        # Idle bots never reach the per-message flush check, so flush on a timer as well
+        self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flush_thread.start()
 
         if DELETE_WEBHOOKS_ON_STARTUP:
             self.delete_all_webhooks()
 
 
     def load_bots(self):
-        """Loads bot data from the database."""
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT owner_id, token, start_message, first_reply FROM bots")
-            for row in cursor.fetchall():
-                owner_id, token, start_message, first_reply = row
-                owner_id = int(owner_id)  # Ensure owner_id is an integer
-                if token not in self.bots:
-                    try:
-                        whispry_instance = WhispryBot(token, owner_id, self.bot, start_message, first_reply)
-                        self.bots[token] = whispry_instance
-                        logger.info(f"Loaded bot {token[-6:]} for owner {owner_id}")
-                    except Exception as e:
-                        logger.exception(f"Failed to load bot {token[-6:]}: {e}")
-
-    def load_message_mappings(self):
-        """Loads message mappings from the database."""
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT owner_id, forwarded_message_id, user_id FROM message_mappings")
-            for row in cursor.fetchall():
-                owner_id, forwarded_message_id, user_id = row
-                # Ensure keys are strings, values are integers (as appropriate)
-                if owner_id not in self.message_mappings:
-                    self.message_mappings[owner_id] = {}
-                self.message_mappings[owner_id][forwarded_message_id] = int(user_id)
+        """Loads bot data from the database and starts the bots in parallel."""
+        with self.pool.read() as conn:
+            rows = conn.execute("SELECT owner_id, token, start_message, first_reply FROM bots").fetchall()
+        to_load = {}
+        for row in rows:
+            owner_id, token, start_message, first_reply = row
+            if token not in self.bots and token not in to_load:
+                to_load[token] = (owner_id, start_message, first_reply)
+
+        # Starting a bot is dominated by its get_me() round-trip, so overlap them
+        with ThreadPoolExecutor(max_workers=BOT_STARTUP_WORKERS) as executor:
+            futures = {
+                executor.submit(WhispryBot, token, owner_id, self.bot, self.pool, start_message, first_reply): token
+                for token, (owner_id, start_message, first_reply) in to_load.items()
+            }
+            for future in as_completed(futures):
+                token = futures[future]
+                try:
+                    whispry_instance = future.result()
+                    self.bots[token] = whispry_instance
+                    self.bots_by_owner[whispry_instance.owner_id].add(token)
+                    logger.info(f"Loaded bot {token[-6:]} for owner {whispry_instance.owner_id}")
+                except Exception as e:
+                    logger.exception(f"Failed to load bot {token[-6:]}: {e}")
 
     def setup_handlers(self):
         @self.bot.message_handler(commands=['newbot'])
         def handle_newbot(message):
-            user_id_str = str(message.from_user.id)
-            with sqlite3.connect(DB_FILE) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM bots WHERE owner_id = ?", (user_id_str,))
+            with self.pool.read() as conn:
+                cursor = conn.execute(SQL_COUNT_OWNER_BOTS, (message.from_user.id,))
                 bot_count = cursor.fetchone()[0]
 
             if bot_count >= 50:
@@ -240,7 +390,6 @@ class Whispry:
 
         @self.bot.message_handler(commands=['start'])
         def handle_start(message):
-            self.update_stats()
             start_message = (
                 "Hi, I'm Whispry.\n"
                 "A privacy-first feedback bot.\n"
@@ -274,15 +423,11 @@ class Whispry:
 
         @self.bot.message_handler(commands=['mybots'])
         def handle_mybots(message):
-            user_id_str = str(message.from_user.id)
-            with sqlite3.connect(DB_FILE) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT token, start_message, first_reply FROM bots WHERE owner_id = ?", (user_id_str,))
-                bot_data = cursor.fetchall()
-
-            if bot_data:
-                bots = {row[0]: {"start_message": row[1], "first_reply": row[2]} for row in bot_data}
-                self.send_bot_list(message.chat.id, user_id_str, bots, 1)
+            owner_id = message.from_user.id
+            bots = self.get_owner_bots(owner_id)
+
+            if bots:
+                self.send_bot_list(message.chat.id, owner_id, bots, 1)
             else:
                 self.bot.reply_to(message, "You don't have any bots yet. Use /newbot.")
 
@@ -290,31 +435,35 @@ class Whispry:
             def callback_query(call):
                 data = call.data.split(":")
                 if data[0] == "manage":
-                    user_id_str, token = data[1], data[2]
-                    self.manage_bot(call.message.chat.id, user_id_str, token)
+                    owner_id, token = int(data[1]), data[2]
+                    self.manage_bot(call.message.chat.id, owner_id, token)
                 elif data[0] == "page":
-                    user_id_str, page = data[1], int(data[2])
-                    with sqlite3.connect(DB_FILE) as conn:
-                        cursor = conn.cursor()
-                        cursor.execute("SELECT token, start_message, first_reply FROM bots WHERE owner_id = ?", (user_id_str,))
-                        bot_data = cursor.fetchall()
-                        bots = {row[0]: {"start_message": row[1], "first_reply": row[2]} for row in bot_data}
-                    self.send_bot_list(call.message.chat.id, user_id_str, bots, page)
+                    owner_id, page = int(data[1]), int(data[2])
+                    bots = self.get_owner_bots(owner_id)
+                    self.send_bot_list(call.message.chat.id, owner_id, bots, page)
 
                 elif data[0] == "delete":
-                    _, user_id_str, token = data
-                    self.delete_bot(call, user_id_str, token)
+                    owner_id, token = int(data[1]), data[2]
+                    self.delete_bot(call, owner_id, token)
                 elif data[0] == "set_start":
-                    _, user_id_str, token = data
+                    token = data[2]
                     self.bot.send_message(call.message.chat.id, "Enter the new /start message:")
                     self.bot.register_next_step_handler(call.message, self.process_start_message, token)
                 elif data[0] == "set_first_reply":
-                    _, user_id_str, token = data
+                    token = data[2]
                     self.bot.send_message(call.message.chat.id, "Enter the auto-reply for the first message:")
                     self.bot.register_next_step_handler(call.message, self.process_first_reply_message, token)
 
 
-    def send_bot_list(self, chat_id, user_id_str, bots, page, per_page=5):
+    def get_owner_bots(self, owner_id):
+        """Returns the owner's bots from the in-memory registry; the DB is only read at startup."""
+        bots = {}
+        for token in sorted(self.bots_by_owner.get(owner_id, ())):
+            whispry_instance = self.bots[token]
+            bots[token] = {"start_message": whispry_instance.start_message, "first_reply": whispry_instance.first_reply}
+        return bots
+
+    def send_bot_list(self, chat_id, owner_id, bots, page, per_page=5):
         bot_names = list(bots.keys())
         total_bots = len(bot_names)
         total_pages = (total_bots + per_page - 1) // per_page
@@ -325,17 +474,17 @@ class Whispry:
         keyboard = types.InlineKeyboardMarkup(row_width=2)
         buttons = []
         for token in current_page_bots:
-            bot_username = self.bots[token].bot.get_me().username
-            callback_data = f"manage:{user_id_str}:{token}"
+            bot_username = self.bots[token].username
+            callback_data = f"manage:{owner_id}:{token}"
             button = types.InlineKeyboardButton(text=bot_username, callback_data=callback_data)
             buttons.append(button)
         keyboard.add(*buttons)
 
         nav_buttons = []
         if page > 1:
-            nav_buttons.append(types.InlineKeyboardButton(text="⬅️ Previous", callback_data=f"page:{user_id_str}:{page - 1}"))
+            nav_buttons.append(types.InlineKeyboardButton(text="⬅️ Previous", callback_data=f"page:{owner_id}:{page - 1}"))
         if page < total_pages:
-            nav_buttons.append(types.InlineKeyboardButton(text="➡️ Next", callback_data=f"page:{user_id_str}:{page + 1}"))
+            nav_buttons.append(types.InlineKeyboardButton(text="➡️ Next", callback_data=f"page:{owner_id}:{page + 1}"))
         if nav_buttons:
             keyboard.row(*nav_buttons)
 
@@ -346,58 +495,51 @@ class Whispry:
             self.bot.send_message(chat_id, "Select a bot to manage:", reply_markup=keyboard)
 
 
-    def manage_bot(self, chat_id, user_id_str, token):
+    def manage_bot(self, chat_id, owner_id, token):
         keyboard = types.InlineKeyboardMarkup(row_width=1)
-        delete_button = types.InlineKeyboardButton(text="Delete Bot", callback_data=f"delete:{user_id_str}:{token}")
-        start_button = types.InlineKeyboardButton(text="Set /start Message", callback_data=f"set_start:{user_id_str}:{token}")
-        first_reply_button = types.InlineKeyboardButton(text="Set First Reply", callback_data=f"set_first_reply:{user_id_str}:{token}")
+        delete_button = types.InlineKeyboardButton(text="Delete Bot", callback_data=f"delete:{owner_id}:{token}")
+        start_button = types.InlineKeyboardButton(text="Set /start Message", callback_data=f"set_start:{owner_id}:{token}")
+        first_reply_button = types.InlineKeyboardButton(text="Set First Reply", callback_data=f"set_first_reply:{owner_id}:{token}")
         keyboard.add(delete_button, start_button, first_reply_button)
         self.bot.send_message(chat_id, "Choose an action:", reply_markup=keyboard)
 
     def process_start_message(self, message, token):
-        start_message = message.text
-        user_id_str = str(message.from_user.id)
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE bots SET start_message = ? WHERE owner_id = ? AND token = ?",
-                           (start_message, user_id_str, token))
-            conn.commit()
-        # Update the bot instance in memory
-        if token in self.bots:
-            self.bots[token].start_message = start_message
+        self._update_bot_field("start_message", message.text, message.from_user.id, token)
         self.bot.reply_to(message, "Start message set.")
 
-
     def process_first_reply_message(self, message, token):
-        first_reply = message.text
-        user_id_str = str(message.from_user.id)
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE bots SET first_reply = ? WHERE owner_id = ? AND token = ?",
-                           (first_reply, user_id_str, token))
-            conn.commit()
+        self._update_bot_field("first_reply", message.text, message.from_user.id, token)
+        self.bot.reply_to(message, "First reply message set.")
 
+    def _update_bot_field(self, field, value, owner_id, token):
+        """Stores a bot setting in the database and on the running bot instance."""
+        if field not in SQL_UPDATE_BOT_FIELD:
+            raise ValueError(f"Unknown bot field: {field}")
+        with self.pool.write() as conn:
+            conn.execute(SQL_UPDATE_BOT_FIELD[field], (value, owner_id, token))
+        # Update the bot instance in memory
         if token in self.bots:
-             self.bots[token].first_reply = first_reply
-        self.bot.reply_to(message, "First reply message set.")
+            setattr(self.bots[token], field, value)
 
-    def delete_bot(self, call, user_id_str, token):
+    def delete_bot(self, call, owner_id, token):
         try:
-            with sqlite3.connect(DB_FILE) as conn:
-                cursor = conn.cursor()
-                # Delete from bots table
-                cursor.execute("DELETE FROM bots WHERE owner_id = ? AND token = ?", (user_id_str, token))
-
-                # Delete from message_counts (using the token, which is the primary key)
-                cursor.execute("DELETE FROM message_counts WHERE token = ?", (token,))
-                conn.commit()
-
+            # Stop first so the final flush of pending counts can't re-create the row below
             if token in self.bots:
                 self.bots[token].stop_polling()
+                self.bots_by_owner[self.bots[token].owner_id].discard(token)
                 del self.bots[token]
 
+            with self.pool.write() as conn:
+                # Delete from bots table
+                deleted_bots = conn.execute("DELETE FROM bots WHERE owner_id = ? AND token = ?",
+                                            (owner_id, token)).rowcount
+
+                # Delete from message_counts (using the token, which is the primary key)
+                result = conn.execute(SQL_GET_COUNT, (token,)).fetchone()
+                conn.execute("DELETE FROM message_counts WHERE token = ?", (token,))
+
+            self.adjust_stats(bots=-deleted_bots, messages=-(result[0] if result else 0))
             self.bot.edit_message_text("Bot deleted.", call.message.chat.id, call.message.message_id)
-            self.update_stats()
 
         except Exception as e:
             logger.exception(f"Error deleting bot: {e}")
@@ -406,10 +548,9 @@ class Whispry:
     def process_token(self, message):
         token = message.text.strip()
         user_id = message.from_user.id
-        user_id_str = str(user_id)
 
         try:
-            if not re.match(r"^[0-9]+:[a-zA-Z0-9_-]+$", token):
+            if not _TOKEN_RE.match(token):
                 self.bot.reply_to(message, "Invalid token format.")
                 return
 
@@ -422,19 +563,18 @@ class Whispry:
                 self.bot.reply_to(message, "This bot is already managed.")
                 return
 
-            whispry_instance = WhispryBot(token, user_id, self.bot)
+            whispry_instance = WhispryBot(token, user_id, self.bot, self.pool)
             self.bots[token] = whispry_instance
+            self.bots_by_owner[user_id].add(token)
 
-            with sqlite3.connect(DB_FILE) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
+            with self.pool.write() as conn:
+                conn.execute("""
                     INSERT INTO bots (owner_id, token, start_message, first_reply)
                     VALUES (?, ?, ?, ?)
-                """, (user_id_str, token, "", ""))  # Insert into bots table
-                conn.commit()
+                """, (user_id, token, "", ""))  # Insert into bots table
 
-            self.update_stats()
-            bot_username = whispry_instance.bot.get_me().username
+            self.adjust_stats(bots=1)
+            bot_username = whispry_instance.username
             self.bot.reply_to(message, f"Bot @{bot_username} added!")
 
         except telebot.apihelper.ApiTelegramException as e:
@@ -445,79 +585,103 @@ class Whispry:
             self.bot.reply_to(message, "An unexpected error occurred.")
 
     def store_message_mapping(self, owner_id, forwarded_message_id, user_id):
-        owner_id_str = str(owner_id)
         forwarded_message_id_str = str(forwarded_message_id)
-        user_id_int = int(user_id)
 
-        if owner_id_str not in self.message_mappings:
-            self.message_mappings[owner_id_str] = {}
-        self.message_mappings[owner_id_str][forwarded_message_id_str] = user_id_int
+        with self._mappings_lock:
+            self.message_mappings[(owner_id, forwarded_message_id_str)] = user_id
 
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO message_mappings (owner_id, forwarded_message_id, user_id)
-                VALUES (?, ?, ?)
-                ON CONFLICT(owner_id, forwarded_message_id) DO NOTHING  -- Prevent duplicates
-            """, (owner_id_str, forwarded_message_id_str, user_id_int))
-            conn.commit()
+        with self.pool.write() as conn:
+            conn.execute(SQL_STORE_MAP, (owner_id, forwarded_message_id_str, user_id))
 
 
     def get_user_id_from_message_id(self, owner_id, forwarded_message_id):
-        owner_id_str = str(owner_id)
         forwarded_message_id_str = str(forwarded_message_id)
+        key = (owner_id, forwarded_message_id_str)
 
         # First try to get it from the in-memory cache
-        if owner_id_str in self.message_mappings and forwarded_message_id_str in self.message_mappings[owner_id_str]:
-            return self.message_mappings[owner_id_str][forwarded_message_id_str]
+        with self._mappings_lock:
+            user_id = self.message_mappings.get(key)
+        if user_id is not None:
+            return user_id
 
         # If not in memory, try to get it from the database
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM message_mappings WHERE owner_id = ? AND forwarded_message_id = ?",
-                           (owner_id_str, forwarded_message_id_str))
+        with self.pool.read() as conn:
+            cursor = conn.execute(SQL_GET_USER, (owner_id, forwarded_message_id_str))
             result = cursor.fetchone()
-            if result:
-                user_id = int(result[0])  # Convert to integer
-                # Update the in-memory cache
-                if owner_id_str not in self.message_mappings:
-                    self.message_mappings[owner_id_str] = {}
-                self.message_mappings[owner_id_str][forwarded_message_id_str] = user_id
-                return user_id
-            else:
-                return None
+        if result:
+            user_id = result[0]
+            # Update the in-memory cache
+            with self._mappings_lock:
+                self.message_mappings[key] = user_id
+            return user_id
+        else:
+            return None
 
 
+    def flush_message_counts(self):
+        """Writes every bot's pending message count increments to the database."""
+        for whispry_instance in list(self.bots.values()):
+            try:
+                whispry_instance.flush_message_count()
+            except Exception as e:
+                logger.exception(f"Failed to flush message count for bot {whispry_instance.token[-6:]}: {e}")
+
+    def _flush_periodically(self):
+        """Flushes every bot's pending message counts each MESSAGE_COUNT_FLUSH_INTERVAL seconds."""
+        while True:
+            time.sleep(MESSAGE_COUNT_FLUSH_INTERVAL)
+            self.flush_message_counts()
+
+    def _handle_sigterm(self, signum, frame):
+        """Flushes pending message counts before exiting on SIGTERM (docker stop, systemd)."""
+        logger.info("Received SIGTERM, flushing message counts...")
+        self.flush_message_counts()
+        sys.exit(0)
+
+    def adjust_stats(self, bots=0, messages=0):
+        """Applies a change to the running bot and message totals."""
+        with self._stats_lock:
+            self.total_bots_count += bots
+            self.total_messages_count += messages
+
     def update_stats(self):
-        """Updates the total bot and message counts."""
-        with sqlite3.connect(DB_FILE) as conn:
+        """Loads the total bot and message counts from the database."""
+        with self.pool.read() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(DISTINCT token) FROM bots")
             self.total_bots_count = cursor.fetchone()[0]
             cursor.execute("SELECT SUM(message_count) FROM message_counts")
             total_messages = cursor.fetchone()[0]
-            self.total_messages_count = total_messages if total_messages is not None else 0
+        self.total_messages_count = total_messages if total_messages is not None else 0
 
     def run(self):
+        signal.signal(signal.SIGTERM, self._handle_sigterm)  # Must be installed from the main thread
         logger.info("Starting Whispry main bot...")
         self.bot.infinity_polling()
 
     def delete_all_webhooks(self):
         """Deletes webhooks for all known bots."""
         logger.info("Deleting webhooks for all bots...")
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT token FROM bots")
-            for row in cursor.fetchall():
-                token = row[0]
+        with self.pool.read() as conn:
+            rows = conn.execute("SELECT token FROM bots").fetchall()
+        with ThreadPoolExecutor(max_workers=WEBHOOK_DELETE_WORKERS) as executor:
+            futures = {executor.submit(self.delete_webhook, row[0]): row[0] for row in rows}
+            for future in as_completed(futures):
+                token = futures[future]
                 try:
-                    temp_bot = telebot.TeleBot(token, parse_mode=None)
-                    temp_bot.delete_webhook()
+                    future.result()
                     logger.info(f"Webhook deleted for bot {token[-6:]}")
                 except Exception as e:
                     logger.exception(f"Failed to delete webhook for bot {token[-6:]}: {e}")
         logger.info("Finished deleting webhooks.")
 
+    def delete_webhook(self, token):
+        """Deletes a bot's webhook, reusing its running TeleBot when there is one."""
+        if token in self.bots:
+            self.bots[token].bot.delete_webhook()
+        else:
+            telebot.TeleBot(token, parse_mode=None).delete_webhook()
+
 if __name__ == "__main__":
     main_whispry = Whispry(BOT_TOKEN)
     main_whispry.run()
\ No newline at end of file
@@ -22,51 +22,67 @@ def migrate_data():
         return
 
     try:
+        bots_data = json_data.get("bots", {})
+        message_mappings = json_data.get("message_mappings", {})
+
+        # Collect every row first, then insert each table with a single executemany
+        # Migrate bot data
+        bots_rows = []
+        for owner_id_str, bot_data in bots_data.items():
+            for token, details in bot_data.items():
+                start_message = details.get("start_message", "")
+                first_reply = details.get("first_reply", "")
+                bots_rows.append((int(owner_id_str), token, start_message, first_reply))  # JSON keys are strings
+
+        # Migrate message mappings
+        mappings_rows = []
+        for owner_id_str, mappings in message_mappings.items():
+            for forwarded_message_id_str, user_id in mappings.items():
+                mappings_rows.append((int(owner_id_str), forwarded_message_id_str, int(user_id)))
+
+        # Migrate message counts (This part is crucial)
+        #  We need to *estimate* the message count. The JSON data
+        #  doesn't store the count directly.  We'll make a reasonable
+        #  guess based on the message mappings.  A more accurate
+        #  count would require analyzing the Telegram chat history,
+        #  which isn't possible through the Bot API.
+        #  Mappings are stored per owner, not per bot, so each owner's
+        #  mappings are split evenly across their bots (the remainder goes
+        #  to the first ones) and the owner's total is preserved.
+        owner_counts = {owner_id_str: len(mappings) for owner_id_str, mappings in message_mappings.items()}
+        counts_rows = []
+        for owner_id_str, bot_data in bots_data.items():
+            owner_id = int(owner_id_str)
+            share, remainder = divmod(owner_counts.get(owner_id_str, 0), max(1, len(bot_data)))
+            for i, token in enumerate(bot_data):
+                counts_rows.append((token, owner_id, share + (1 if i < remainder else 0)))
+
         with sqlite3.connect(DB_FILE) as conn:
+            # One-shot bulk load: safe to re-run if it crashes, so skip the fsyncs.
+            # The journal mode is left alone; main.py keeps the database in WAL.
+            conn.execute("PRAGMA synchronous=OFF")
             cursor = conn.cursor()
-
-            # Migrate bot data
-            bots_data = json_data.get("bots", {})
-            for owner_id_str, bot_data in bots_data.items():
-                for token, details in bot_data.items():
-                    start_message = details.get("start_message", "")
-                    first_reply = details.get("first_reply", "")
-                    cursor.execute("""
-                        INSERT INTO bots (owner_id, token, start_message, first_reply)
-                        VALUES (?, ?, ?, ?)
-                        ON CONFLICT(owner_id, token) DO UPDATE
-                        SET start_message = excluded.start_message,
-                            first_reply = excluded.first_reply
-                    """, (owner_id_str, token, start_message, first_reply))
-
-            # Migrate message mappings
-            message_mappings = json_data.get("message_mappings", {})
-            for owner_id_str, mappings in message_mappings.items():
-                for forwarded_message_id_str, user_id in mappings.items():
-                    cursor.execute("""
-                        INSERT INTO message_mappings (owner_id, forwarded_message_id, user_id)
-                        VALUES (?, ?, ?)
-                        ON CONFLICT(owner_id, forwarded_message_id) DO NOTHING
-                    """, (owner_id_str, forwarded_message_id_str, int(user_id))) # Convert user_id to int
-
-
-            # Migrate message counts (This part is crucial)
-            for owner_id_str, bot_data in bots_data.items():
-                for token, _ in bot_data.items():
-                    #  We need to *estimate* the message count. The JSON data
-                    #  doesn't store the count directly.  We'll make a reasonable
-                    #  guess based on the message mappings.  A more accurate
-                    #  count would require analyzing the Telegram chat history,
-                    #  which isn't possible through the Bot API.
-                    message_count = 0
-                    if owner_id_str in message_mappings:
-                        message_count = len(message_mappings[owner_id_str]) # Estimate: number of mappings
-
-                    cursor.execute("""
-                        INSERT INTO message_counts (token, owner_id, message_count)
-                        VALUES (?, ?, ?)
-                        ON CONFLICT(token) DO UPDATE SET message_count = excluded.message_count
-                    """, (token, int(owner_id_str), message_count))
+            cursor.execute("BEGIN")
+
+            cursor.executemany("""
+                INSERT INTO bots (owner_id, token, start_message, first_reply)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(owner_id, token) DO UPDATE
+                SET start_message = excluded.start_message,
+                    first_reply = excluded.first_reply
+            """, bots_rows)
+
+            cursor.executemany("""
+                INSERT INTO message_mappings (owner_id, forwarded_message_id, user_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT(owner_id, forwarded_message_id) DO NOTHING
+            """, mappings_rows)
+
+            cursor.executemany("""
+                INSERT INTO message_counts (token, owner_id, message_count)
+                VALUES (?, ?, ?)
+                ON CONFLICT(token) DO UPDATE SET message_count = excluded.message_count
+            """, counts_rows)
 
             conn.commit()
             logger.info("Data migration completed successfully.")